@@ -18,6 +18,7 @@ from __future__ import absolute_import, division, print_function, \
     with_statement
 
 import os
+import hashlib
 import logging
 
 
@@ -102,6 +103,55 @@ def find_library(possible_lib_names, search_symbol, library_name):
     return None
 
 
+_hmac_trans_5c = bytes(bytearray((x ^ 0x5C) for x in range(256)))
+_hmac_trans_36 = bytes(bytearray((x ^ 0x36) for x in range(256)))
+
+
+def hmac_md5_digest(key, data):
+    # type: (bytes, bytes) -> bytes
+    """
+    one-shot HMAC-MD5, same result as hmac.new(key, data, hashlib.md5).digest()
+
+    skips building a hmac.HMAC object (and copying its two md5 states)
+    which dominates the cost for the small messages used by the protocols
+    """
+    ipad, opad = _hmac_md5_pads(key)
+    inner = hashlib.md5(ipad)
+    inner.update(data)
+    return hashlib.md5(opad + inner.digest()).digest()
+
+
+def _hmac_md5_pads(key):
+    # the HMAC-MD5 key blocks: key xor ipad, key xor opad
+    if len(key) > 64:
+        key = hashlib.md5(key).digest()
+    key = bytes(key) + b'\0' * (64 - len(key))
+    return key.translate(_hmac_trans_36), key.translate(_hmac_trans_5c)
+
+
+class hmac_md5(object):
+    """
+    HMAC-MD5 with a fixed key, for keys used on many messages
+
+    the md5 states after the key blocks are kept and copied, so a digest
+    only hashes the data and the inner digest
+    """
+    __slots__ = ('inner', 'outer')
+
+    def __init__(self, key):
+        ipad, opad = _hmac_md5_pads(key)
+        self.inner = hashlib.md5(ipad)
+        self.outer = hashlib.md5(opad)
+
+    def digest(self, data):
+        # type: (bytes) -> bytes
+        inner = self.inner.copy()
+        inner.update(data)
+        outer = self.outer.copy()
+        outer.update(inner.digest())
+        return outer.digest()
+
+
 def run_cipher(cipher, decipher):
     from os import urandom
     import random
@@ -144,5 +194,28 @@ def test_find_library():
                         'EVP_CipherUpdate', 'libc') is not None
 
 
+def test_hmac_md5_digest():
+    import hmac
+    for key_len in (0, 16, 20, 63, 64, 65, 100):
+        key = os.urandom(key_len)
+        for data_len in (0, 1, 64, 1500):
+            data = os.urandom(data_len)
+            assert hmac_md5_digest(key, data) == \
+                hmac.new(key, data, hashlib.md5).digest()
+
+
+def test_hmac_md5():
+    import hmac
+    for key_len in (0, 16, 20, 63, 64, 65, 100):
+        key = os.urandom(key_len)
+        key_hmac = hmac_md5(key)
+        for data_len in (0, 1, 64, 1500):
+            data = os.urandom(data_len)
+            assert key_hmac.digest(data) == \
+                hmac.new(key, data, hashlib.md5).digest()
+
+
 if __name__ == '__main__':
     test_find_library()
+    test_hmac_md5_digest()
+    test_hmac_md5()
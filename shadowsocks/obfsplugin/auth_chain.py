@@ -27,7 +27,6 @@ import datetime
 import random
 import math
 import struct
-import hmac
 import bisect
 
 import shadowsocks
@@ -35,9 +34,17 @@ from shadowsocks import common, lru_cache, encrypt
 from shadowsocks.obfsplugin import plain
 from shadowsocks.common import to_bytes, to_str, ord, chr
 from shadowsocks.crypto import openssl
+from shadowsocks.crypto.util import hmac_md5, hmac_md5_digest
 
 rand_bytes = openssl.rand_bytes
 
+# precompiled formats, saves parsing the format string on every packet
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_U64_PAIR = struct.Struct('<QQ')
+_U64_BE = struct.Struct('>Q')
+
+
 def create_auth_chain_a(method):
     return auth_chain_a(method)
 
@@ -73,6 +80,11 @@ obfs_map = {
 
 
 class xorshift128plus(object):
+    # the generator is part of the protocol: clients draw the same sequence.
+    # in python it is also cheaper than xoroshiro128+, whose two 64-bit
+    # rotations cost more big-int operations than the shifts here
+    __slots__ = ('v0', 'v1')
+
     max_int = (1 << 64) - 1
     mov_mask = (1 << (64 - 23)) - 1
 
@@ -84,25 +96,137 @@ class xorshift128plus(object):
         x = self.v0
         y = self.v1
         self.v0 = y
-        x ^= ((x & xorshift128plus.mov_mask) << 23)
-        x ^= (y ^ (x >> 17) ^ (y >> 26))
+        # masks are inlined as literals (mov_mask / max_int) to skip the
+        # class attribute lookups. mov_mask can not be dropped: x >> 17
+        # would shift bits above 64 back into the state
+        x ^= (x & 0x1FFFFFFFFFF) << 23
+        x ^= y ^ (x >> 17) ^ (y >> 26)
         self.v1 = x
-        return (x + y) & xorshift128plus.max_int
+        return (x + y) & 0xFFFFFFFFFFFFFFFF
+
+    def next_list(self, count):
+        # same as [self.next() for i in range(count)], with the state kept
+        # in locals instead of a method call and two attribute writes per value
+        v0 = self.v0
+        v1 = self.v1
+        ret = []
+        for i in range(count):
+            x = v0 ^ ((v0 & 0x1FFFFFFFFFF) << 23)
+            x ^= v1 ^ (x >> 17) ^ (v1 >> 26)
+            ret.append((x + v1) & 0xFFFFFFFFFFFFFFFF)
+            v0 = v1
+            v1 = x
+        self.v0 = v0
+        self.v1 = v1
+        return ret
 
     def init_from_bin(self, bin):
         if len(bin) < 16:
             bin += b'\0' * 16
-        self.v0 = struct.unpack('<Q', bin[:8])[0]
-        self.v1 = struct.unpack('<Q', bin[8:16])[0]
+        self.v0, self.v1 = _U64_PAIR.unpack_from(bin)
 
     def init_from_bin_len(self, bin, length):
         if len(bin) < 16:
             bin += b'\0' * 16
-        self.v0 = struct.unpack('<Q', struct.pack('<H', length) + bin[2:8])[0]
-        self.v1 = struct.unpack('<Q', bin[8:16])[0]
+        v0, v1 = _U64_PAIR.unpack_from(bin)
+        # the low 16 bits of v0 are replaced by length
+        v0 = (v0 & 0xFFFFFFFFFFFF0000) | length
 
+        # 4 warm-up rounds of next(), run on locals: this is done for every
+        # packet, in both directions
         for i in range(4):
-            self.next()
+            x = v0 ^ ((v0 & 0x1FFFFFFFFFF) << 23)
+            v0 = v1
+            v1 = x ^ v1 ^ (x >> 17) ^ (v1 >> 26)
+        self.v0 = v0
+        self.v1 = v1
+
+    def next_from_bin_len(self, bin, length):
+        # init_from_bin_len(bin, length) followed by next(), fused into one
+        # call: this is the per-packet padding draw
+        if len(bin) < 16:
+            bin += b'\0' * 16
+        v0, v1 = _U64_PAIR.unpack_from(bin)
+        v0 = (v0 & 0xFFFFFFFFFFFF0000) | length
+
+        # the 4 warm-up rounds and the drawn one
+        for i in range(5):
+            x = v0 ^ ((v0 & 0x1FFFFFFFFFF) << 23)
+            v0 = v1
+            v1 = x ^ v1 ^ (x >> 17) ^ (v1 >> 26)
+        self.v0 = v0
+        self.v1 = v1
+        return (v0 + v1) & 0xFFFFFFFFFFFFFFFF
+
+
+class packet_hmac_md5(object):
+    # HMAC-MD5 keyed with user_key + pack('<I', packet_id)
+    # user_key is fixed for a connection, so the padded key blocks are
+    # xored once and only the 4 packet_id bytes change per packet
+    __slots__ = ('key_md5', 'ipad_head', 'ipad_tail', 'opad_head', 'opad_tail')
+
+    def __init__(self, user_key):
+        if len(user_key) + 4 > 64:
+            # over-long keys are hashed first, keep the md5 state of user_key
+            self.key_md5 = hashlib.md5(user_key)
+            return
+        self.key_md5 = None
+        key = bytearray(user_key)
+        self.ipad_head = bytes(bytearray(x ^ 0x36 for x in key))
+        self.opad_head = bytes(bytearray(x ^ 0x5C for x in key))
+        self.ipad_tail = b'\x36' * (60 - len(key))
+        self.opad_tail = b'\x5C' * (60 - len(key))
+
+    def digest(self, packet_id, data, data_tail=b''):
+        # MAC of data + data_tail, without joining them first
+        if self.key_md5 is not None:
+            key_md5 = self.key_md5.copy()
+            key_md5.update(_U32.pack(packet_id))
+            return hmac_md5_digest(key_md5.digest(), data + data_tail)
+        # each key block is joined in one allocation, only packet_id is new
+        inner = hashlib.md5(b''.join((self.ipad_head, _U32.pack(packet_id ^ 0x36363636), self.ipad_tail)))
+        inner.update(data)
+        inner.update(data_tail)
+        return hashlib.md5(b''.join((self.opad_head, _U32.pack(packet_id ^ 0x5C5C5C5C), self.opad_tail,
+                                     inner.digest()))).digest()
+
+
+# padding modulus by data size (0~1440): > 1300: 31, > 900: 127, > 400: 521, else 1021
+# shared by the size ladders of auth_chain_a, b and c
+rnd_data_len_mod = tuple(31 if size > 1300 else 127 if size > 900 else 521 if size > 400 else 1021
+                         for size in range(1441))
+
+
+# padding size for a random value r: data_size_mod[r % 2340] == r % 2340 % 2040 % 1440
+data_size_mod = tuple(i % 2040 % 1440 for i in range(2340))
+
+
+def rand_data_size_list(random, list_len):
+    # list_len sorted padding sizes, drawn in one batch and sorted in place
+    # (sorted() would copy the new list first). one full draw per size:
+    # clients derive the same list, so the draws are part of the protocol
+    size_list = [data_size_mod[r % 2340] for r in random.next_list(list_len)]
+    size_list.sort()
+    return size_list
+
+
+def data_size_pos_table(size_list):
+    # table[size] == bisect.bisect_left(size_list, size) for every size up
+    # to size_list[-1], so rnd_data_len can index instead of searching
+    table = []
+    for pos, size in enumerate(size_list):
+        table.extend([pos] * (size + 1 - len(table)))
+    return tuple(table)
+
+
+def udp_rc4(key, buf):
+    # same output as encrypt.Encryptor(key, 'rc4').encrypt(buf), whose
+    # EVP_BytesToKey reduces the key to md5(key). skips the Encryptor
+    # bookkeeping and the second context its decrypt() would allocate.
+    # the key ends with the HMAC of 3~7 fresh random bytes, so it never
+    # repeats between datagrams and a pool of keyed contexts would not hit
+    return openssl.OpenSSLCrypto(b'rc4', hashlib.md5(key).digest(), b'', 1).update(buf)
+
 
 def match_begin(str1, str2):
     if len(str1) >= len(str2):
@@ -208,6 +332,10 @@ class obfs_auth_chain_data(object):
         self.user_id = {}
         self.local_client_id = b''
         self.connection_id = 0
+        self.user_key_hmac = {}
+        self.user_key_b64 = {}
+        self.key_hmac = {}
+        self.data_size_lists = {}
         self.set_max_client(64)  # max active client count
 
     def update(self, user_id, client_id, connection_id):
@@ -222,6 +350,45 @@ class obfs_auth_chain_data(object):
         self.max_client = max_client
         self.max_buffer = max(self.max_client * 2, 1024)
 
+    def _get_cached(self, table_name, key, factory):
+        # the table is shared by all the connections of the server and is
+        # emptied once it holds max_buffer entries
+        table = getattr(self, table_name)
+        value = table.get(key, None)
+        if value is None:
+            if len(table) >= self.max_buffer:
+                table = {}
+                setattr(self, table_name, table)
+            value = factory(key)
+            table[key] = value
+        return value
+
+    def get_user_key_hmac(self, user_key):
+        # packet_hmac_md5 is read only once built, so all the connections
+        # of one user share it instead of xoring the key pads again
+        return self._get_cached('user_key_hmac', user_key, packet_hmac_md5)
+
+    def get_data_size_lists(self, key, version=None):
+        item = self.data_size_lists.get(key, None)
+        if item is not None and item[0] == version:
+            return item[1]
+        return None
+
+    def set_data_size_lists(self, key, data_size_lists, version=None):
+        # one entry per key, a new version (time slot) replaces the old one
+        if key not in self.data_size_lists and len(self.data_size_lists) >= self.max_buffer:
+            self.data_size_lists = {}
+        self.data_size_lists[key] = (version, data_size_lists)
+
+    def get_key_hmac(self, key):
+        # fixed-key HMAC for the UDP packets, keyed by server or user key
+        return self._get_cached('key_hmac', key, hmac_md5)
+
+    def get_user_key_b64(self, user_key):
+        # base64 of user_key is part of every cipher key (and of every UDP
+        # packet key), encode it once per user
+        return self._get_cached('user_key_b64', user_key, base64.b64encode)
+
     def insert(self, user_id, client_id, connection_id):
         if user_id not in self.user_id:
             self.user_id[user_id] = lru_cache.LRUCache()
@@ -258,6 +425,13 @@ class obfs_auth_chain_data(object):
 
 
 class auth_chain_a(auth_base):
+    # server side state, read from the class until the header is accepted,
+    # so client connections (and probes that never authenticate) skip it
+    client_id = 0
+    connection_id = 0
+    user_id_num = 0
+    max_time_dif = 60 * 60 * 24  # time dif (second) setting
+
     def __init__(self, method):
         super(auth_chain_a, self).__init__(method)
         self.hashfunc = hashlib.md5
@@ -266,16 +440,13 @@ class auth_chain_a(auth_base):
         self.raw_trans = False
         self.has_sent_header = False
         self.has_recv_header = False
-        self.client_id = 0
-        self.connection_id = 0
-        self.max_time_dif = 60 * 60 * 24  # time dif (second) setting
         self.salt = b"auth_chain_a"
         self.no_compatible_method = 'auth_chain_a'
         self.pack_id = 1
         self.recv_id = 1
         self.user_id = None
-        self.user_id_num = 0
         self.user_key = None
+        self.user_key_hmac = None
         self.overhead = 4
         self.client_over_head = 4
         self.last_client_hash = b''
@@ -290,12 +461,26 @@ class auth_chain_a(auth_base):
     def get_overhead(self, direction):  # direction: true for c->s false for s->c
         return self.overhead
 
-    def set_server_info(self, server_info):
-        self.server_info = server_info
+    def parse_protocol_param(self, protocol_param):
+        # server side protocol_param is max_client[#option],
+        # max_client is 64 when it is missing or not a number.
+        # a param that can not be split on '#' (None, or the bytes that
+        # db_transfer passes on python 3) gives the defaults, as before
         try:
-            max_client = int(server_info.protocol_param.split('#')[0])
+            params = protocol_param.split('#')
         except:
-            max_client = 64
+            return 64, []
+        max_client = 64
+        if params[0]:
+            try:
+                max_client = int(params[0])
+            except:
+                pass
+        return max_client, params[1:]
+
+    def set_server_info(self, server_info):
+        self.server_info = server_info
+        max_client = self.parse_protocol_param(server_info.protocol_param)[0]
         self.server_info.data.set_max_client(max_client)
 
     def trapezoid_random_float(self, d):
@@ -312,14 +497,7 @@ class auth_chain_a(auth_base):
     def rnd_data_len(self, buf_size, last_hash, random):
         if buf_size > 1440:
             return 0
-        random.init_from_bin_len(last_hash, buf_size)
-        if buf_size > 1300:
-            return random.next() % 31
-        if buf_size > 900:
-            return random.next() % 127
-        if buf_size > 400:
-            return random.next() % 521
-        return random.next() % 1021
+        return random.next_from_bin_len(last_hash, buf_size) % rnd_data_len_mod[buf_size]
 
     def udp_rnd_data_len(self, last_hash, random):
         random.init_from_bin(last_hash)
@@ -333,70 +511,66 @@ class auth_chain_a(auth_base):
     def rnd_data(self, buf_size, buf, last_hash, random):
         rand_len = self.rnd_data_len(buf_size, last_hash, random)
 
-        rnd_data_buf = rand_bytes(rand_len)
-
         if buf_size == 0:
-            return rnd_data_buf
+            return rand_bytes(rand_len)
         else:
             if rand_len > 0:
+                rnd_data_buf = rand_bytes(rand_len)
                 start_pos = self.rnd_start_pos(rand_len, random)
-                return rnd_data_buf[:start_pos] + buf + rnd_data_buf[start_pos:]
+                # join sizes the result once, instead of two concats
+                return b''.join((rnd_data_buf[:start_pos], buf, rnd_data_buf[start_pos:]))
             else:
                 return buf
 
     def pack_client_data(self, buf):
         buf = self.encryptor.encrypt(buf)
         data = self.rnd_data(len(buf), buf, self.last_client_hash, self.random_client)
-        mac_key = self.user_key + struct.pack('<I', self.pack_id)
-        length = len(buf) ^ struct.unpack('<H', self.last_client_hash[14:])[0]
-        data = struct.pack('<H', length) + data
-        self.last_client_hash = hmac.new(mac_key, data, self.hashfunc).digest()
-        data += self.last_client_hash[:2]
+        length = _U16.pack(len(buf) ^ _U16.unpack_from(self.last_client_hash, 14)[0])
+        # the MAC covers length + data, the packet is joined only once
+        self.last_client_hash = self.user_key_hmac.digest(self.pack_id, length, data)
         self.pack_id = (self.pack_id + 1) & 0xFFFFFFFF
-        return data
+        return b''.join((length, data, self.last_client_hash[:2]))
 
     def pack_server_data(self, buf):
         buf = self.encryptor.encrypt(buf)
         data = self.rnd_data(len(buf), buf, self.last_server_hash, self.random_server)
-        mac_key = self.user_key + struct.pack('<I', self.pack_id)
-        length = len(buf) ^ struct.unpack('<H', self.last_server_hash[14:])[0]
-        data = struct.pack('<H', length) + data
-        self.last_server_hash = hmac.new(mac_key, data, self.hashfunc).digest()
-        data += self.last_server_hash[:2]
+        length = _U16.pack(len(buf) ^ _U16.unpack_from(self.last_server_hash, 14)[0])
+        self.last_server_hash = self.user_key_hmac.digest(self.pack_id, length, data)
         self.pack_id = (self.pack_id + 1) & 0xFFFFFFFF
-        return data
+        return b''.join((length, data, self.last_server_hash[:2]))
 
     def pack_auth_data(self, auth_data, buf):
         data = auth_data
-        data = data + (struct.pack('<H', self.server_info.overhead) + struct.pack('<H', 0))
+        data = data + (_U16.pack(self.server_info.overhead) + b'\x00\x00')
         mac_key = self.server_info.iv + self.server_info.key
 
         check_head = rand_bytes(4)
-        self.last_client_hash = hmac.new(mac_key, check_head, self.hashfunc).digest()
+        self.last_client_hash = hmac_md5_digest(mac_key, check_head)
         check_head += self.last_client_hash[:8]
 
         if b':' in to_bytes(self.server_info.protocol_param):
             try:
                 items = to_bytes(self.server_info.protocol_param).split(b':')
                 self.user_key = items[1]
-                uid = struct.pack('<I', int(items[0]))
+                uid = _U32.pack(int(items[0]))
             except:
                 uid = rand_bytes(4)
         else:
             uid = rand_bytes(4)
         if self.user_key is None:
             self.user_key = self.server_info.key
+        self.user_key_hmac = self.server_info.data.get_user_key_hmac(self.user_key)
+        user_key_b64 = self.server_info.data.get_user_key_b64(self.user_key)
 
-        encryptor = encrypt.Encryptor(
-            to_bytes(base64.b64encode(self.user_key)) + self.salt, 'aes-128-cbc', b'\x00' * 16)
+        encryptor = encrypt.Encryptor(user_key_b64 + self.salt, 'aes-128-cbc', b'\x00' * 16)
 
-        uid = struct.unpack('<I', uid)[0] ^ struct.unpack('<I', self.last_client_hash[8:12])[0]
-        uid = struct.pack('<I', uid)
+        uid = _U32.unpack(uid)[0] ^ _U32.unpack_from(self.last_client_hash, 8)[0]
+        uid = _U32.pack(uid)
         data = uid + encryptor.encrypt(data)[16:]
-        self.last_server_hash = hmac.new(self.user_key, data, self.hashfunc).digest()
+        self.last_server_hash = hmac_md5_digest(self.user_key, data)
         data = check_head + data + self.last_server_hash[:4]
         self.encryptor = encrypt.Encryptor(
-            to_bytes(base64.b64encode(self.user_key)) + to_bytes(base64.b64encode(self.last_client_hash)), 'rc4')
+            user_key_b64 + base64.b64encode(self.last_client_hash), 'rc4')
         return data + self.pack_client_data(buf)
 
     def auth_data(self):
@@ -406,96 +580,114 @@ class auth_chain_a(auth_base):
         if not self.server_info.data.local_client_id:
             self.server_info.data.local_client_id = rand_bytes(4)
             logging.debug("local_client_id %s" % (binascii.hexlify(self.server_info.data.local_client_id),))
-            self.server_info.data.connection_id = struct.unpack('<I', rand_bytes(4))[0] & 0xFFFFFF
+            self.server_info.data.connection_id = _U32.unpack(rand_bytes(4))[0] & 0xFFFFFF
         self.server_info.data.connection_id += 1
-        return b''.join([struct.pack('<I', utc_time),
+        return b''.join([_U32.pack(utc_time),
                          self.server_info.data.local_client_id,
-                         struct.pack('<I', self.server_info.data.connection_id)])
+                         _U32.pack(self.server_info.data.connection_id)])
 
     def on_recv_auth_data(self, utc_time):
         pass
 
     def client_pre_encrypt(self, buf):
-        ret = b''
+        # collect the packets and join once, += on bytes copies everything
+        # packed so far for every packet
+        ret = []
         ogn_data_len = len(buf)
         if not self.has_sent_header:
             head_size = self.get_head_size(buf, 30)
             datalen = min(len(buf), random.randint(0, 31) + head_size)
-            ret += self.pack_auth_data(self.auth_data(), buf[:datalen])
+            ret.append(self.pack_auth_data(self.auth_data(), buf[:datalen]))
             buf = buf[datalen:]
             self.has_sent_header = True
-        while len(buf) > self.unit_len:
-            ret += self.pack_client_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_client_data(buf)
-        return ret
+        unit_len = self.unit_len
+        pos = 0
+        while len(buf) - pos > unit_len:
+            ret.append(self.pack_client_data(buf[pos:pos + unit_len]))
+            pos += unit_len
+        ret.append(self.pack_client_data(buf[pos:]))
+        return b''.join(ret)
 
     def client_post_decrypt(self, buf):
         if self.raw_trans:
             return buf
         self.recv_buf += buf
-        out_buf = b''
-        while len(self.recv_buf) > 4:
-            mac_key = self.user_key + struct.pack('<I', self.recv_id)
-            data_len = struct.unpack('<H', self.recv_buf[:2])[0] ^ struct.unpack('<H', self.last_server_hash[14:16])[0]
-            rand_len = self.rnd_data_len(data_len, self.last_server_hash, self.random_server)
+        out_bufs = []
+        # walk the frames by offset and trim recv_buf once at the end,
+        # re-slicing it per frame copies the tail again for every frame
+        recv_pos = 0
+        # recv_buf, the cipher and the HMAC do not change inside the loop
+        recv_buf = self.recv_buf
+        buf_len = len(recv_buf)
+        digest = self.user_key_hmac.digest
+        decrypt = self.encryptor.decrypt
+        random_server = self.random_server
+        while buf_len - recv_pos > 4:
+            last_server_hash = self.last_server_hash
+            data_len = _U16.unpack_from(recv_buf, recv_pos)[0] ^ _U16.unpack_from(last_server_hash, 14)[0]
+            rand_len = self.rnd_data_len(data_len, last_server_hash, random_server)
             length = data_len + rand_len
             if length >= 4096:
                 self.raw_trans = True
                 self.recv_buf = b''
                 raise Exception('client_post_decrypt data error')
 
-            if length + 4 > len(self.recv_buf):
+            if length + 4 > buf_len - recv_pos:
                 break
 
-            server_hash = hmac.new(mac_key, self.recv_buf[:length + 2], self.hashfunc).digest()
-            if server_hash[:2] != self.recv_buf[length + 2: length + 4]:
+            server_hash = digest(self.recv_id, recv_buf[recv_pos:recv_pos + length + 2])
+            if server_hash[:2] != recv_buf[recv_pos + length + 2:recv_pos + length + 4]:
                 logging.info('%s: checksum error, data %s'
-                             % (self.no_compatible_method, binascii.hexlify(self.recv_buf[:length])))
+                             % (self.no_compatible_method,
+                                binascii.hexlify(recv_buf[recv_pos:recv_pos + length])))
                 self.raw_trans = True
                 self.recv_buf = b''
                 raise Exception('client_post_decrypt data uncorrect checksum')
 
-            pos = 2
+            pos = recv_pos + 2
             if data_len > 0 and rand_len > 0:
-                pos = 2 + self.rnd_start_pos(rand_len, self.random_server)
-            out_buf += self.encryptor.decrypt(self.recv_buf[pos: data_len + pos])
+                pos += self.rnd_start_pos(rand_len, random_server)
+            data = decrypt(recv_buf[pos:pos + data_len])
             self.last_server_hash = server_hash
             if self.recv_id == 1:
-                self.server_info.tcp_mss = struct.unpack('<H', out_buf[:2])[0]
-                out_buf = out_buf[2:]
+                self.server_info.tcp_mss = _U16.unpack_from(data)[0]
+                data = data[2:]
+            out_bufs.append(data)
             self.recv_id = (self.recv_id + 1) & 0xFFFFFFFF
-            self.recv_buf = self.recv_buf[length + 4:]
+            recv_pos += length + 4
 
-        return out_buf
+        if recv_pos:
+            self.recv_buf = recv_buf[recv_pos:]
+        return b''.join(out_bufs)
 
     def server_pre_encrypt(self, buf):
         if self.raw_trans:
             return buf
-        ret = b''
+        ret = []
         if self.pack_id == 1:
             tcp_mss = self.server_info.tcp_mss if self.server_info.tcp_mss < 1500 else 1500
             self.server_info.tcp_mss = tcp_mss
-            buf = struct.pack('<H', tcp_mss) + buf
+            buf = _U16.pack(tcp_mss) + buf
             self.unit_len = tcp_mss - self.client_over_head
-        while len(buf) > self.unit_len:
-            ret += self.pack_server_data(buf[:self.unit_len])
-            buf = buf[self.unit_len:]
-        ret += self.pack_server_data(buf)
-        return ret
+        unit_len = self.unit_len
+        pos = 0
+        while len(buf) - pos > unit_len:
+            ret.append(self.pack_server_data(buf[pos:pos + unit_len]))
+            pos += unit_len
+        ret.append(self.pack_server_data(buf[pos:]))
+        return b''.join(ret)
 
     def server_post_decrypt(self, buf):
         if self.raw_trans:
             return (buf, False)
         self.recv_buf += buf
-        out_buf = b''
         sendback = False
 
         if not self.has_recv_header:
             if len(self.recv_buf) >= 12 or len(self.recv_buf) in [7, 8]:
                 recv_len = min(len(self.recv_buf), 12)
                 mac_key = self.server_info.recv_iv + self.server_info.key
-                md5data = hmac.new(mac_key, self.recv_buf[:4], self.hashfunc).digest()
+                md5data = hmac_md5_digest(mac_key, self.recv_buf[:4])
                 if md5data[:recv_len - 4] != self.recv_buf[4:recv_len]:
                     return self.not_match_return(self.recv_buf)
 
@@ -503,9 +695,10 @@ class auth_chain_a(auth_base):
                 return (b'', False)
 
             self.last_client_hash = md5data
-            uid = struct.unpack('<I', self.recv_buf[12:16])[0] ^ struct.unpack('<I', md5data[8:12])[0]
+            uid = _U32.unpack_from(self.recv_buf, 12)[0] ^ _U32.unpack_from(md5data, 8)[0]
             self.user_id_num = uid
-            uid = struct.pack('<I', uid)
+            uid = _U32.pack(uid)
+            shared_key = True
             if uid in self.server_info.users:
                 self.user_id = uid
                 self.user_key = self.server_info.users[uid]
@@ -515,9 +708,12 @@ class auth_chain_a(auth_base):
                 if not self.server_info.users:
                     self.user_key = self.server_info.key
                 else:
+                    # recv_iv is picked by the client, keep it out of the
+                    # shared per-key caches
                     self.user_key = self.server_info.recv_iv
+                    shared_key = False
 
-            md5data = hmac.new(self.user_key, self.recv_buf[12: 12 + 20], self.hashfunc).digest()
+            md5data = hmac_md5_digest(self.user_key, self.recv_buf[12: 12 + 20])
             if md5data[:4] != self.recv_buf[32:36]:
                 logging.error('%s data uncorrect auth HMAC-MD5 from %s:%d, data %s' % (
                     self.no_compatible_method, self.server_info.client, self.server_info.client_port,
@@ -528,13 +724,19 @@ class auth_chain_a(auth_base):
                 return self.not_match_return(self.recv_buf)
 
             self.last_server_hash = md5data
-            encryptor = encrypt.Encryptor(to_bytes(base64.b64encode(self.user_key)) + self.salt, 'aes-128-cbc')
+            if shared_key:
+                self.user_key_hmac = self.server_info.data.get_user_key_hmac(self.user_key)
+                user_key_b64 = self.server_info.data.get_user_key_b64(self.user_key)
+            else:
+                self.user_key_hmac = packet_hmac_md5(self.user_key)
+                user_key_b64 = base64.b64encode(self.user_key)
+            encryptor = encrypt.Encryptor(user_key_b64 + self.salt, 'aes-128-cbc')
             head = encryptor.decrypt(b'\x00' * 16 + self.recv_buf[16:32] + b'\x00')  # need an extra byte or recv empty
-            self.client_over_head = struct.unpack('<H', head[12:14])[0]
+            self.client_over_head = _U16.unpack_from(head, 12)[0]
 
-            utc_time = struct.unpack('<I', head[:4])[0]
-            client_id = struct.unpack('<I', head[4:8])[0]
-            connection_id = struct.unpack('<I', head[8:12])[0]
+            utc_time = _U32.unpack_from(head)[0]
+            client_id = _U32.unpack_from(head, 4)[0]
+            connection_id = _U32.unpack_from(head, 8)[0]
             time_dif = common.int32(utc_time - (int(time.time()) & 0xffffffff))
             if time_dif < -self.max_time_dif or time_dif > self.max_time_dif:
                 logging.info('%s: wrong timestamp, time_dif %d, data %s' % (
@@ -546,20 +748,27 @@ class auth_chain_a(auth_base):
                 self.client_id = client_id
                 self.connection_id = connection_id
             else:
-                logging.info('%s: auth fail, data %s' % (self.no_compatible_method, binascii.hexlify(out_buf)))
+                logging.info('%s: auth fail, data %s' % (self.no_compatible_method, binascii.hexlify(head)))
                 return self.not_match_return(self.recv_buf)
 
             self.on_recv_auth_data(utc_time)
             self.encryptor = encrypt.Encryptor(
-                to_bytes(base64.b64encode(self.user_key)) + to_bytes(base64.b64encode(self.last_client_hash)), 'rc4')
+                user_key_b64 + base64.b64encode(self.last_client_hash), 'rc4')
             self.recv_buf = self.recv_buf[36:]
             self.has_recv_header = True
             sendback = True
 
-        while len(self.recv_buf) > 4:
-            mac_key = self.user_key + struct.pack('<I', self.recv_id)
-            data_len = struct.unpack('<H', self.recv_buf[:2])[0] ^ struct.unpack('<H', self.last_client_hash[14:16])[0]
-            rand_len = self.rnd_data_len(data_len, self.last_client_hash, self.random_client)
+        out_bufs = []
+        recv_pos = 0
+        recv_buf = self.recv_buf
+        buf_len = len(recv_buf)
+        digest = self.user_key_hmac.digest
+        decrypt = self.encryptor.decrypt
+        random_client = self.random_client
+        while buf_len - recv_pos > 4:
+            last_client_hash = self.last_client_hash
+            data_len = _U16.unpack_from(recv_buf, recv_pos)[0] ^ _U16.unpack_from(last_client_hash, 14)[0]
+            rand_len = self.rnd_data_len(data_len, last_client_hash, random_client)
             length = data_len + rand_len
             if length >= 4096:
                 self.raw_trans = True
@@ -570,13 +779,13 @@ class auth_chain_a(auth_base):
                 else:
                     raise Exception('server_post_decrype data error')
 
-            if length + 4 > len(self.recv_buf):
+            if length + 4 > buf_len - recv_pos:
                 break
 
-            client_hash = hmac.new(mac_key, self.recv_buf[:length + 2], self.hashfunc).digest()
-            if client_hash[:2] != self.recv_buf[length + 2: length + 4]:
+            client_hash = digest(self.recv_id, recv_buf[recv_pos:recv_pos + length + 2])
+            if client_hash[:2] != recv_buf[recv_pos + length + 2:recv_pos + length + 4]:
                 logging.info('%s: checksum error, data %s' % (
-                    self.no_compatible_method, binascii.hexlify(self.recv_buf[:length])
+                    self.no_compatible_method, binascii.hexlify(recv_buf[recv_pos:recv_pos + length])
                 ))
                 self.raw_trans = True
                 self.recv_buf = b''
@@ -586,15 +795,19 @@ class auth_chain_a(auth_base):
                     raise Exception('server_post_decrype data uncorrect checksum')
 
             self.recv_id = (self.recv_id + 1) & 0xFFFFFFFF
-            pos = 2
+            pos = recv_pos + 2
             if data_len > 0 and rand_len > 0:
-                pos = 2 + self.rnd_start_pos(rand_len, self.random_client)
-            out_buf += self.encryptor.decrypt(self.recv_buf[pos: data_len + pos])
+                pos += self.rnd_start_pos(rand_len, random_client)
+            out_bufs.append(decrypt(recv_buf[pos:pos + data_len]))
             self.last_client_hash = client_hash
-            self.recv_buf = self.recv_buf[length + 4:]
+            recv_pos += length + 4
             if data_len == 0:
                 sendback = True
 
+        if recv_pos:
+            self.recv_buf = recv_buf[recv_pos:]
+
+        out_buf = b''.join(out_bufs)
         if out_buf:
             self.server_info.data.update(self.user_id, self.client_id, self.connection_id)
         return (out_buf, sendback)
@@ -605,7 +818,7 @@ class auth_chain_a(auth_base):
                 try:
                     items = to_bytes(self.server_info.protocol_param).split(':')
                     self.user_key = self.hashfunc(items[1]).digest()
-                    self.user_id = struct.pack('<I', int(items[0]))
+                    self.user_id = _U32.pack(int(items[0]))
                 except:
                     pass
             if self.user_key is None:
@@ -613,29 +826,27 @@ class auth_chain_a(auth_base):
                 self.user_key = self.server_info.key
         authdata = rand_bytes(3)
         mac_key = self.server_info.key
-        md5data = hmac.new(mac_key, authdata, self.hashfunc).digest()
-        uid = struct.unpack('<I', self.user_id)[0] ^ struct.unpack('<I', md5data[:4])[0]
-        uid = struct.pack('<I', uid)
+        md5data = self.server_info.data.get_key_hmac(mac_key).digest(authdata)
+        uid = _U32.unpack(self.user_id)[0] ^ _U32.unpack_from(md5data)[0]
+        uid = _U32.pack(uid)
         rand_len = self.udp_rnd_data_len(md5data, self.random_client)
-        encryptor = encrypt.Encryptor(
-            to_bytes(base64.b64encode(self.user_key)) + to_bytes(base64.b64encode(md5data)), 'rc4')
-        out_buf = encryptor.encrypt(buf)
+        out_buf = udp_rc4(self.server_info.data.get_user_key_b64(self.user_key) + base64.b64encode(md5data), buf)
         buf = out_buf + rand_bytes(rand_len) + authdata + uid
-        return buf + hmac.new(self.user_key, buf, self.hashfunc).digest()[:1]
+        return buf + self.server_info.data.get_key_hmac(self.user_key).digest(buf)[:1]
 
     def client_udp_post_decrypt(self, buf):
         if len(buf) <= 8:
             return (b'', None)
-        if hmac.new(self.user_key, buf[:-1], self.hashfunc).digest()[:1] != buf[-1:]:
+        if self.server_info.data.get_key_hmac(self.user_key).digest(buf[:-1])[:1] != buf[-1:]:
             return (b'', None)
         mac_key = self.server_info.key
-        md5data = hmac.new(mac_key, buf[-8:-1], self.hashfunc).digest()
+        md5data = self.server_info.data.get_key_hmac(mac_key).digest(buf[-8:-1])
         rand_len = self.udp_rnd_data_len(md5data, self.random_server)
-        encryptor = encrypt.Encryptor(
-            to_bytes(base64.b64encode(self.user_key)) + to_bytes(base64.b64encode(md5data)), 'rc4')
-        return encryptor.decrypt(buf[:-8 - rand_len])
+        return udp_rc4(self.server_info.data.get_user_key_b64(self.user_key) + base64.b64encode(md5data),
+                       buf[:-8 - rand_len])
 
     def server_udp_pre_encrypt(self, buf, uid):
+        shared_key = True
         if uid in self.server_info.users:
             user_key = self.server_info.users[uid]
         else:
@@ -643,21 +854,30 @@ class auth_chain_a(auth_base):
             if not self.server_info.users:
                 user_key = self.server_info.key
             else:
+                # recv_iv changes with every packet, keep it out of the
+                # shared per-key caches
                 user_key = self.server_info.recv_iv
+                shared_key = False
         authdata = rand_bytes(7)
         mac_key = self.server_info.key
-        md5data = hmac.new(mac_key, authdata, self.hashfunc).digest()
+        md5data = self.server_info.data.get_key_hmac(mac_key).digest(authdata)
         rand_len = self.udp_rnd_data_len(md5data, self.random_server)
-        encryptor = encrypt.Encryptor(to_bytes(base64.b64encode(user_key)) + to_bytes(base64.b64encode(md5data)), 'rc4')
-        out_buf = encryptor.encrypt(buf)
+        if shared_key:
+            user_key_b64 = self.server_info.data.get_user_key_b64(user_key)
+        else:
+            user_key_b64 = base64.b64encode(user_key)
+        out_buf = udp_rc4(user_key_b64 + base64.b64encode(md5data), buf)
         buf = out_buf + rand_bytes(rand_len) + authdata
-        return buf + hmac.new(user_key, buf, self.hashfunc).digest()[:1]
+        if shared_key:
+            return buf + self.server_info.data.get_key_hmac(user_key).digest(buf)[:1]
+        return buf + hmac_md5_digest(user_key, buf)[:1]
 
     def server_udp_post_decrypt(self, buf):
         mac_key = self.server_info.key
-        md5data = hmac.new(mac_key, buf[-8:-5], self.hashfunc).digest()
-        uid = struct.unpack('<I', buf[-5:-1])[0] ^ struct.unpack('<I', md5data[:4])[0]
-        uid = struct.pack('<I', uid)
+        md5data = self.server_info.data.get_key_hmac(mac_key).digest(buf[-8:-5])
+        uid = _U32.unpack(buf[-5:-1])[0] ^ _U32.unpack_from(md5data)[0]
+        uid = _U32.pack(uid)
+        shared_key = True
         if uid in self.server_info.users:
             user_key = self.server_info.users[uid]
         else:
@@ -665,12 +885,22 @@ class auth_chain_a(auth_base):
             if not self.server_info.users:
                 user_key = self.server_info.key
             else:
+                # recv_iv changes with every packet, keep it out of the
+                # shared per-key caches
                 user_key = self.server_info.recv_iv
-        if hmac.new(user_key, buf[:-1], self.hashfunc).digest()[:1] != buf[-1:]:
+                shared_key = False
+        if shared_key:
+            mac = self.server_info.data.get_key_hmac(user_key).digest(buf[:-1])
+        else:
+            mac = hmac_md5_digest(user_key, buf[:-1])
+        if mac[:1] != buf[-1:]:
             return (b'', None)
         rand_len = self.udp_rnd_data_len(md5data, self.random_client)
-        encryptor = encrypt.Encryptor(to_bytes(base64.b64encode(user_key)) + to_bytes(base64.b64encode(md5data)), 'rc4')
-        out_buf = encryptor.decrypt(buf[:-8 - rand_len])
+        if shared_key:
+            user_key_b64 = self.server_info.data.get_user_key_b64(user_key)
+        else:
+            user_key_b64 = base64.b64encode(user_key)
+        out_buf = udp_rc4(user_key_b64 + base64.b64encode(md5data), buf[:-8 - rand_len])
         return (out_buf, uid)
 
     def dispose(self):
@@ -689,59 +919,65 @@ class auth_chain_b(auth_chain_a):
         self.data_size_list = []
         self.data_size_list2 = []
 
-    def init_data_size(self, key):
-        if self.data_size_list:
-            self.data_size_list = []
-            self.data_size_list2 = []
+    def get_shared_data_size(self, key, make_data_size, version=None):
+        # the size lists are a pure function of the server key (and the time
+        # slot for auth_chain_f) and the connections only read them, so they
+        # are built once per server by make_data_size() and shared
+        data = self.server_info.data
+        data_size_lists = data.get_data_size_lists(key, version)
+        if data_size_lists is None:
+            data_size_lists = make_data_size()
+            data.set_data_size_lists(key, data_size_lists, version)
+        return data_size_lists
+
+    def make_data_size(self, key):
         random = xorshift128plus()
         random.init_from_bin(key)
         # 补全数组长为4~12-1
         list_len = random.next() % 8 + 4
-        for i in range(0, list_len):
-            self.data_size_list.append((int)(random.next() % 2340 % 2040 % 1440))
-        self.data_size_list.sort()
+        data_size_list = rand_data_size_list(random, list_len)
         # 补全数组长为8~24-1
         list_len = random.next() % 16 + 8
-        for i in range(0, list_len):
-            self.data_size_list2.append((int)(random.next() % 2340 % 2040 % 1440))
-        self.data_size_list2.sort()
+        data_size_list2 = rand_data_size_list(random, list_len)
+        return data_size_list, data_size_list2
+
+    def init_data_size(self, key):
+        self.data_size_list, self.data_size_list2 = self.get_shared_data_size(
+            key, lambda: self.make_data_size(key))
 
     def set_server_info(self, server_info):
-        self.server_info = server_info
-        try:
-            max_client = int(server_info.protocol_param.split('#')[0])
-        except:
-            max_client = 64
-        self.server_info.data.set_max_client(max_client)
+        super(auth_chain_b, self).set_server_info(server_info)
         self.init_data_size(self.server_info.key)
 
     def rnd_data_len(self, buf_size, last_hash, random):
         if buf_size >= 1440:
             return 0
-        random.init_from_bin_len(last_hash, buf_size)
-        pos = bisect.bisect_left(self.data_size_list, buf_size + self.server_info.overhead)
-        final_pos = pos + random.next() % (len(self.data_size_list))
+        # overhead is not cached in set_server_info: on the server side
+        # tcprelay only sets the final value once the first packet arrives
+        other_data_size = buf_size + self.server_info.overhead
+        # the size lists are only a few items long: a single C bisect beats
+        # any scan written in python, so only the attribute lookups are hoisted
+        size_list = self.data_size_list
+        list_len = len(size_list)
+        pos = bisect.bisect_left(size_list, other_data_size)
+        final_pos = pos + random.next_from_bin_len(last_hash, buf_size) % list_len
         # 假设random均匀分布，则越长的原始数据长度越容易if false
-        if final_pos < len(self.data_size_list):
-            return self.data_size_list[final_pos] - buf_size - self.server_info.overhead
+        if final_pos < list_len:
+            return size_list[final_pos] - other_data_size
 
         # 上面if false后选择2号补全数组，此处有更精细的长度分段
-        pos = bisect.bisect_left(self.data_size_list2, buf_size + self.server_info.overhead)
-        final_pos = pos + random.next() % (len(self.data_size_list2))
-        if final_pos < len(self.data_size_list2):
-            return self.data_size_list2[final_pos] - buf_size - self.server_info.overhead
+        size_list = self.data_size_list2
+        list_len = len(size_list)
+        pos = bisect.bisect_left(size_list, other_data_size)
+        final_pos = pos + random.next() % list_len
+        if final_pos < list_len:
+            return size_list[final_pos] - other_data_size
         # final_pos 总是分布在pos~(data_size_list2.len-1)之间
-        if final_pos < pos + len(self.data_size_list2) - 1:
+        if final_pos < pos + list_len - 1:
             return 0
         # 有1/len(self.data_size_list2)的概率不满足上一个if
 
-        if buf_size > 1300:
-            return random.next() % 31
-        if buf_size > 900:
-            return random.next() % 127
-        if buf_size > 400:
-            return random.next() % 521
-        return random.next() % 1021
+        return random.next() % rnd_data_len_mod[buf_size]
 
 
 class auth_chain_c(auth_chain_b):
@@ -750,48 +986,37 @@ class auth_chain_c(auth_chain_b):
         self.salt = b"auth_chain_c"
         self.no_compatible_method = 'auth_chain_c'
         self.data_size_list0 = []
+        self.data_size_pos0 = ()
 
-    def init_data_size(self, key):
-        if self.data_size_list0:
-            self.data_size_list0 = []
+    def make_data_size(self, key):
         random = xorshift128plus()
         random.init_from_bin(key)
         # 补全数组长为12~24-1
         list_len = random.next() % (8 + 16) + (4 + 8)
-        for i in range(0, list_len):
-            self.data_size_list0.append((int)(random.next() % 2340 % 2040 % 1440))
-        self.data_size_list0.sort()
+        data_size_list0 = rand_data_size_list(random, list_len)
+        return data_size_list0, data_size_pos_table(data_size_list0)
 
-    def set_server_info(self, server_info):
-        self.server_info = server_info
-        try:
-            max_client = int(server_info.protocol_param.split('#')[0])
-        except:
-            max_client = 64
-        self.server_info.data.set_max_client(max_client)
-        self.init_data_size(self.server_info.key)
+    def init_data_size(self, key):
+        self.data_size_list0, self.data_size_pos0 = self.get_shared_data_size(
+            key, lambda: self.make_data_size(key))
 
     def rnd_data_len(self, buf_size, last_hash, random):
         other_data_size = buf_size + self.server_info.overhead
+        size_list = self.data_size_list0
         # 一定要在random使用前初始化，以保证服务器与客户端同步，保证包大小验证结果正确
-        random.init_from_bin_len(last_hash, buf_size)
+        # (next_from_bin_len seeds and draws in one call. without padding
+        # random is not seeded: rnd_start_pos does not read it then)
         # final_pos 总是分布在pos~(data_size_list0.len-1)之间
         # 除非data_size_list0中的任何值均过小使其全部都无法容纳buf
-        if other_data_size >= self.data_size_list0[-1]:
+        if other_data_size >= size_list[-1]:
             if other_data_size >= 1440:
                 return 0
-            if other_data_size > 1300:
-                return random.next() % 31
-            if other_data_size > 900:
-                return random.next() % 127
-            if other_data_size > 400:
-                return random.next() % 521
-            return random.next() % 1021
-
-        pos = bisect.bisect_left(self.data_size_list0, other_data_size)
+            return random.next_from_bin_len(last_hash, buf_size) % rnd_data_len_mod[other_data_size]
+
+        pos = self.data_size_pos0[other_data_size]
         # random select a size in the leftover data_size_list0
-        final_pos = pos + random.next() % (len(self.data_size_list0) - pos)
-        return self.data_size_list0[final_pos] - other_data_size
+        final_pos = pos + random.next_from_bin_len(last_hash, buf_size) % (len(size_list) - pos)
+        return size_list[final_pos] - other_data_size
 
 
 class auth_chain_d(auth_chain_b):
@@ -800,51 +1025,45 @@ class auth_chain_d(auth_chain_b):
         self.salt = b"auth_chain_d"
         self.no_compatible_method = 'auth_chain_d'
         self.data_size_list0 = []
-
-    def check_and_patch_data_size(self, random):
-        # append new item
-        # when the biggest item(first time) or the last append item(other time) are not big enough.
-        # but set a limit size (64) to avoid stack overflow.
-        if self.data_size_list0[-1] < 1300 and len(self.data_size_list0) < 64:
-            self.data_size_list0.append((int)(random.next() % 2340 % 2040 % 1440))
-            self.check_and_patch_data_size(random)
-
-    def init_data_size(self, key):
-        if self.data_size_list0:
-            self.data_size_list0 = []
+        self.data_size_pos0 = ()
+
+    def check_and_patch_data_size(self, random, data_size_list0):
+        # add new item
+        # when the biggest item(first time) or the last added item(other time) are not big enough.
+        # but set a limit size (64) on the list length.
+        # items are inserted in order, so the list needs no re-sort, and
+        # [-1] is only >= 1300 once the last added item is.
+        # draws stay one by one: how many are needed depends on the values,
+        # and the list is built once per server key (get_shared_data_size)
+        while data_size_list0[-1] < 1300 and len(data_size_list0) < 64:
+            bisect.insort(data_size_list0, data_size_mod[random.next() % 2340])
+
+    def make_data_size(self, key):
         random = xorshift128plus()
         random.init_from_bin(key)
         # 补全数组长为12~24-1
         list_len = random.next() % (8 + 16) + (4 + 8)
-        for i in range(0, list_len):
-            self.data_size_list0.append((int)(random.next() % 2340 % 2040 % 1440))
-        self.data_size_list0.sort()
-        old_len = len(self.data_size_list0)
-        self.check_and_patch_data_size(random)
-        # if check_and_patch_data_size are work, re-sort again.
-        if old_len != len(self.data_size_list0):
-            self.data_size_list0.sort()
+        data_size_list0 = rand_data_size_list(random, list_len)
+        self.check_and_patch_data_size(random, data_size_list0)
+        return data_size_list0, data_size_pos_table(data_size_list0)
 
-    def set_server_info(self, server_info):
-        self.server_info = server_info
-        try:
-            max_client = int(server_info.protocol_param.split('#')[0])
-        except:
-            max_client = 64
-        self.server_info.data.set_max_client(max_client)
-        self.init_data_size(self.server_info.key)
+    def init_data_size(self, key):
+        self.data_size_list0, self.data_size_pos0 = self.get_shared_data_size(
+            key, lambda: self.make_data_size(key))
 
     def rnd_data_len(self, buf_size, last_hash, random):
         other_data_size = buf_size + self.server_info.overhead
+        size_list = self.data_size_list0
         # if other_data_size > the bigest item in data_size_list0, not padding any data
-        if other_data_size >= self.data_size_list0[-1]:
+        # (checked first: full-size packets of a bulk transfer take this
+        # exit, and pay neither the lookup nor the PRNG seeding)
+        if other_data_size >= size_list[-1]:
             return 0
 
-        random.init_from_bin_len(last_hash, buf_size)
-        pos = bisect.bisect_left(self.data_size_list0, other_data_size)
+        pos = self.data_size_pos0[other_data_size]
         # random select a size in the leftover data_size_list0
-        final_pos = pos + random.next() % (len(self.data_size_list0) - pos)
-        return self.data_size_list0[final_pos] - other_data_size
+        final_pos = pos + random.next_from_bin_len(last_hash, buf_size) % (len(size_list) - pos)
+        return size_list[final_pos] - other_data_size
 
 
 class auth_chain_e(auth_chain_d):
@@ -854,15 +1073,17 @@ class auth_chain_e(auth_chain_d):
         self.no_compatible_method = 'auth_chain_e'
 
     def rnd_data_len(self, buf_size, last_hash, random):
-        random.init_from_bin_len(last_hash, buf_size)
         other_data_size = buf_size + self.server_info.overhead
+        size_list = self.data_size_list0
         # if other_data_size > the bigest item in data_size_list0, not padding any data
-        if other_data_size >= self.data_size_list0[-1]:
+        if other_data_size >= size_list[-1]:
             return 0
 
+        # the padding size itself takes no random value, random is only
+        # seeded for rnd_start_pos, which is not called without padding
+        random.init_from_bin_len(last_hash, buf_size)
         # use the mini size in the data_size_list0
-        pos = bisect.bisect_left(self.data_size_list0, other_data_size)
-        return self.data_size_list0[pos] - other_data_size
+        return size_list[self.data_size_pos0[other_data_size]] - other_data_size
 
 
 # auth_chain_f
@@ -875,37 +1096,135 @@ class auth_chain_f(auth_chain_e):
 
     def set_server_info(self, server_info):
         self.server_info = server_info
-        try:
-            max_client = int(server_info.protocol_param.split('#')[0])
-        except:
-            max_client = 64
+        max_client, options = self.parse_protocol_param(server_info.protocol_param)
         self.server_info.data.set_max_client(max_client)
         try:
-            self.key_change_interval = int(server_info.protocol_param.split('#')[1])  # config are in second
+            self.key_change_interval = int(options[0])  # config are in second
         except:
             self.key_change_interval = 60 * 60 * 24  # a day by second
-        self.key_change_datetime_key = int(int(time.time()) / self.key_change_interval)
-        self.key_change_datetime_key_bytes = []  # big bit first list
-        for i in range(7, -1, -1):  # big-ending compare to c
-            self.key_change_datetime_key_bytes.append((self.key_change_datetime_key >> (8 * i)) & 0xFF)
+        # truncate toward zero like int(time.time() / interval) does
+        now = int(time.time())
+        if self.key_change_interval > 0:
+            self.key_change_datetime_key = now // self.key_change_interval
+        else:
+            self.key_change_datetime_key = -(now // -self.key_change_interval)
         self.init_data_size(self.server_info.key)
 
+    def make_data_size(self, key):
+        # key xor with key_change_datetime_key: the first 8 bytes as one
+        # big-endian word (big bit first, big-ending compare to c)
+        new_key = _U64_BE.pack(_U64_BE.unpack_from(key)[0] ^
+                               (self.key_change_datetime_key & 0xFFFFFFFFFFFFFFFF)) + key[8:]
+        return super(auth_chain_f, self).make_data_size(new_key)
+
     def init_data_size(self, key):
-        if self.data_size_list0:
-            self.data_size_list0 = []
-        random = xorshift128plus()
-        # key xor with key_change_datetime_key
-        new_key = bytearray(key)
-        for i in range(0, 8):
-            new_key[i] ^= self.key_change_datetime_key_bytes[i]
-        random.init_from_bin(new_key)
-        # 补全数组长为12~24-1
-        list_len = random.next() % (8 + 16) + (4 + 8)
-        for i in range(0, list_len):
-            self.data_size_list0.append(int(random.next() % 2340 % 2040 % 1440))
-        self.data_size_list0.sort()
-        old_len = len(self.data_size_list0)
-        self.check_and_patch_data_size(random)
-        # if check_and_patch_data_size are work, re-sort again.
-        if old_len != len(self.data_size_list0):
-            self.data_size_list0.sort()
+        # the list changes with every key_change_interval
+        self.data_size_list0, self.data_size_pos0 = self.get_shared_data_size(
+            key, lambda: self.make_data_size(key), self.key_change_datetime_key)
+
+
+def test_packet_hmac_md5():
+    import os
+    import hmac
+    for key_len in (0, 59, 60, 61, 64, 65, 100):
+        user_key = os.urandom(key_len)
+        key_hmac = packet_hmac_md5(user_key)
+        for packet_id in (0, 1, 0x36363636, 0xFFFFFFFF):
+            for data, data_tail in ((b'', b''), (os.urandom(2), b''),
+                                    (os.urandom(2), os.urandom(1500))):
+                assert key_hmac.digest(packet_id, data, data_tail) == \
+                    hmac.new(user_key + _U32.pack(packet_id), data + data_tail, hashlib.md5).digest()
+
+
+def test_parse_protocol_param():
+    protocol = auth_chain_a('auth_chain_a')
+    for param, result in ((None, (64, [])), ('', (64, [])), ('10', (10, [])),
+                          ('x#3600', (64, ['3600'])), ('10#3600', (10, ['3600']))):
+        assert protocol.parse_protocol_param(param) == result
+        if param is not None and bytes != str:
+            assert protocol.parse_protocol_param(to_bytes(param)) == (64, [])
+
+
+def test_auth_chain_f_protocol_param():
+    from shadowsocks import obfs
+    # bytes params (python 3 db_transfer) keep the defaults
+    for param, max_client, key_change_interval in (
+            ('10#3600', 10, 3600), (None, 64, 60 * 60 * 24),
+            (b'10#3600', 10 if bytes == str else 64, 3600 if bytes == str else 60 * 60 * 24)):
+        server_info = obfs.server_info(obfs_auth_chain_data('auth_chain_f'))
+        server_info.key = b'k' * 16
+        server_info.protocol_param = param
+        protocol = auth_chain_f('auth_chain_f')
+        protocol.set_server_info(server_info)
+        assert server_info.data.max_client == max_client
+        assert protocol.key_change_interval == key_change_interval
+
+
+def test_data_size_pos_table():
+    rand = random.Random(0)
+    size_lists = [[0], [5], [0, 0, 3], [2, 2, 2], [1, 4, 4, 9, 9, 9, 12]]
+    for i in range(100):
+        size_lists.append(sorted(rand.randint(0, 1400) for j in range(rand.randint(1, 24))))
+    for size_list in size_lists:
+        table = data_size_pos_table(size_list)
+        assert len(table) == size_list[-1] + 1
+        for size in range(size_list[-1] + 1):
+            assert table[size] == bisect.bisect_left(size_list, size)
+
+
+def test_xorshift128plus_next_from_bin_len():
+    import os
+    for bin_len in (0, 4, 15, 16, 20):
+        for length in (0, 1, 1460, 0xFFFF):
+            bin = os.urandom(bin_len)
+            random0 = xorshift128plus()
+            random0.init_from_bin_len(bin, length)
+            value = random0.next()
+            random1 = xorshift128plus()
+            assert random1.next_from_bin_len(bin, length) == value
+            assert (random1.v0, random1.v1) == (random0.v0, random0.v1)
+            assert random1.next() == random0.next()
+
+
+def test_xorshift128plus_known_answer():
+    # computed with the original xorshift128plus
+    values = [1233072381763787927, 7790721341373605965, 11319944476147753716,
+              10146803659368414774, 5402440990935553078, 1198988760579204131]
+    random = xorshift128plus()
+    random.init_from_bin(b'auth_chain_seed!')
+    assert [random.next() for i in range(6)] == values
+    random.init_from_bin(b'auth_chain_seed!')
+    assert random.next_list(6) == values
+
+    values = [15113325759310679580, 4545845577582626761, 10609024059981771338]
+    random.init_from_bin_len(b'short', 1460)
+    assert [random.next() for i in range(3)] == values
+    assert random.next_from_bin_len(b'short', 1460) == values[0]
+    assert random.next_list(2) == values[1:]
+
+
+def test_data_size_list_known_answer():
+    # computed with the original size list code
+    key = b'0123456789abcdef'
+    assert auth_chain_b('auth_chain_b').make_data_size(key) == (
+        [69, 143, 787, 861, 1319],
+        [43, 51, 79, 110, 114, 118, 130, 231, 242, 297, 318, 367, 413, 534, 624, 674, 827, 832, 862, 1218,
+         1226, 1315, 1319])
+    data_size_list0 = auth_chain_d('auth_chain_d').make_data_size(key)[0]
+    assert data_size_list0 == [51, 69, 79, 110, 118, 130, 143, 231, 297, 367, 413, 511, 534, 624, 787, 861,
+                               862, 1226, 1315, 1319, 1319]
+    protocol = auth_chain_f('auth_chain_f')
+    protocol.key_change_datetime_key = 472222
+    data_size_list0 = protocol.make_data_size(key)[0]
+    assert data_size_list0 == [33, 78, 126, 142, 199, 201, 232, 269, 270, 363, 373, 477, 505, 566, 677, 754,
+                               773, 839, 905, 1020, 1374]
+
+
+if __name__ == '__main__':
+    test_packet_hmac_md5()
+    test_parse_protocol_param()
+    test_auth_chain_f_protocol_param()
+    test_data_size_pos_table()
+    test_xorshift128plus_next_from_bin_len()
+    test_xorshift128plus_known_answer()
+    test_data_size_list_known_answer()